@@ -2,18 +2,14 @@
 
 import argparse
 import datetime
-import getpass
 import logging
-import pathlib
-import platform
+import os
 import re
-import smtplib
-import ssl
+import stat
 import subprocess
 import sys
 import tempfile
-
-from email.message import EmailMessage
+import time
 
 LOG = None
 LOG_FORMAT = '%(asctime)s | %(levelname)s | %(message)s'
@@ -22,13 +18,21 @@ DEFAULT_MAX_TEMP = 25
 DEFAULT_LOG_FILE = '/var/log/ipmi-check-temperature.log'
 DEFAULT_LASTNOTIFY_FILE = '/tmp/ipmi-check-temperature.last-notification.txt'
 DEFAULT_LASTNOTIFY_COOLDOWN = 60 * 10 # send max of 1 email every 10 mins
+DEFAULT_SDR_CACHE_FILE = '/run/ipmi-check-temperature.sdr-cache'
+DEFAULT_SDR_CACHE_TTL = 30 # reuse a temperature reading for 30 secs
 IPMI_SDR_PREFIXES = [
     'Inlet Temp',
     'Ambient Temp',
 ]
+IPMI_SDR_PREFIX_TUPLE = tuple(IPMI_SDR_PREFIXES)
+IPMI_SDR_TEMP_RE = re.compile(r'(\d+) degrees C')
+TAIL_BLOCK_SIZE = 4096
 
 SMTP_PORT = 465
 SMTP_HOST = 'localhost'
+SMTP_TIMEOUT = 10
+EMAIL_HOSTNAME = None
+EMAIL_USERNAME = None
 EMAIL_SUBJECT = "Temperature {current_temp} exceeds max (host: {hostname})"
 EMAIL_FROM = "{username}@{hostname}"
 EMAIL_TEMPLATE = """
@@ -59,12 +63,32 @@ parser.add_argument('--cooldown', dest='notify_cooldown', type=int, default=DEFA
                     help=f'second to wait before sending another notification (default: {DEFAULT_LASTNOTIFY_COOLDOWN})')
 parser.add_argument('--notifyfile', dest='notify_file', type=str, default=DEFAULT_LASTNOTIFY_FILE,
                     help=f'file to record the last notification (default: {DEFAULT_LASTNOTIFY_FILE})')
+parser.add_argument('--cachefile', dest='cache_file', type=str, default=DEFAULT_SDR_CACHE_FILE,
+                    help=f'file to cache the last temperature reading (default: {DEFAULT_SDR_CACHE_FILE})')
+parser.add_argument('--cache-ttl', dest='cache_ttl', type=int, default=DEFAULT_SDR_CACHE_TTL,
+                    help=f'seconds to reuse a cached temperature reading, 0 to disable (default: {DEFAULT_SDR_CACHE_TTL})')
+parser.add_argument('--skip-if-cooldown', dest='skip_if_cooldown', action='store_true',
+                    help=f'do not check (or log) the temperature while waiting for a notification cooldown')
 
 
-def run(*, max_temp, log_file, notify_file, notify_cooldown, notify_emails):
+def run(*, max_temp, log_file, notify_file, notify_cooldown, notify_emails, cache_file, cache_ttl,
+        skip_if_cooldown):
     """Checks temperature and sends notification if necessary"""
 
-    current_temp = get_temperature()
+    try:
+        last_notification = get_last_notification(notify_file)
+    except IOError as err:
+        LOG.warning(f"failed to read last notification from {notify_file}: {err}")
+        last_notification = 0
+
+    now_ts = time.time()
+    seconds_until_next_notification = notify_cooldown - (now_ts - last_notification)
+
+    if skip_if_cooldown and seconds_until_next_notification > 0:
+        LOG.info(f"Skipping temperature check (waiting {int(seconds_until_next_notification)}s for cooldown)")
+        return
+
+    current_temp = get_temperature(cache_file=cache_file, cache_ttl=cache_ttl)
 
     warning_state = False
     if current_temp > max_temp:
@@ -73,11 +97,6 @@ def run(*, max_temp, log_file, notify_file, notify_cooldown, notify_emails):
     LOG.info("Current temp is {} (max {})   [{}]".format(
         current_temp, max_temp, "WARNING" if warning_state else "OKAY"))
 
-    last_notification = get_last_notification(notify_file)
-
-    now = datetime.datetime.now()
-    seconds_until_next_notification = notify_cooldown - (now.timestamp() - last_notification)
-    
     action = None
     if warning_state:
         if seconds_until_next_notification < 0:
@@ -98,15 +117,19 @@ def run(*, max_temp, log_file, notify_file, notify_cooldown, notify_emails):
                                 current_temp=current_temp, 
                                 max_temp=max_temp)
 
-    log_cols = [str(now),
+    log_cols = [datetime.datetime.fromtimestamp(now_ts).isoformat(sep=' '),
                 str(current_temp), 
                 str(max_temp), 
                 "WARNING" if warning_state else '-',
                 action if action is not None else '-',
                 str(int(seconds_until_next_notification)) if action == ACTION_NO_NOTIFICATION_COOLDOWN else '-',]
 
-    with open(args.log_file, 'at') as fh:
-        fh.write('\t'.join(log_cols) + "\n")
+    line = ('\t'.join(log_cols) + "\n").encode('utf-8')
+    fd = os.open(log_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
 
 
 
@@ -115,9 +138,21 @@ def run(*, max_temp, log_file, notify_file, notify_cooldown, notify_emails):
 def send_email_notification(*, log_file, notify_file, notify_emails, current_temp, max_temp):
     """Sends email notification"""
 
+    global EMAIL_HOSTNAME, EMAIL_USERNAME
+
+    import smtplib
+
+    from email.message import EmailMessage
+
+    if EMAIL_HOSTNAME is None:
+        import getpass
+        import platform
+        EMAIL_HOSTNAME = platform.node()
+        EMAIL_USERNAME = getpass.getuser()
+
     tmpl_args = {
-        'hostname': platform.node(),
-        'username': getpass.getuser(),
+        'hostname': EMAIL_HOSTNAME,
+        'username': EMAIL_USERNAME,
         'current_temp': current_temp,
         'max_temp': max_temp,
         'last_log_lines': get_last_lines(log_file),
@@ -133,76 +168,234 @@ def send_email_notification(*, log_file, notify_file, notify_emails, current_tem
     msg['To'] = ', '.join(notify_emails)
 
     LOG.info(f"Sending notification to {notify_emails}")
-    with smtplib.SMTP(SMTP_HOST, SMTP_PORT) as server:
+    with smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=SMTP_TIMEOUT) as server:
         server.send_message(msg)
 
     LOG.info(f"Touching notify file {notify_file}")
-    pathlib.Path(notify_file).touch()
+    os.close(os.open(notify_file, os.O_WRONLY | os.O_CREAT, 0o644))
+    os.utime(notify_file, None)
 
 
-def get_temperature():
+def get_temperature(*, cache_file=None, cache_ttl=0):
     """
-    Returns the temperature from `ipmitool sdr`
+    Returns the temperature from the BMC
 
-    ::
+    The sensor is read directly via `pyghmi` (if installed), otherwise 
+    the temperature is parsed from the output of `ipmitool sdr`.
 
-    $ sudo ipmitool sdr  | grep -i 'inlet temp'
-    Inlet Temp       | 21 degrees C      | ok
-    
+    If `cache_file` was written less than `cache_ttl` seconds ago, the 
+    temperature stored there is returned instead of querying the BMC.
+    """
+
+    if cache_file and cache_ttl > 0:
+        temp = get_cached_temperature(cache_file, cache_ttl)
+        if temp is not None:
+            return temp
+
+    temp = get_pyghmi_temperature()
+    if temp is None:
+        temp = get_ipmitool_temperature()
+
+    if cache_file and cache_ttl > 0:
+        set_cached_temperature(cache_file, temp)
+
+    return temp
+
+
+def get_pyghmi_temperature():
+    """
+    Returns the temperature from the local BMC via `pyghmi` (or None if unavailable)
+
+    Sensors are matched against `IPMI_SDR_PREFIXES` in SDR order, the same way 
+    as the `ipmitool sdr` output is parsed, so both pick the same sensor.
     """
 
     try:
-        result = subprocess.run(['ipmitool', 'sdr'], 
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding='utf-8', check=True)
+        from pyghmi.ipmi import command
+    except ImportError:
+        return None
+
+    try:
+        ipmi = command.Command()
+        sensor_names = [sensor['name'] for sensor in ipmi.get_sensor_descriptions()]
     except Exception as err:
-        msg = f"failed to run ipmitool: OUT: {err.stdout} ERR:{err.stderr}"
-        LOG.error(msg)
-        raise
+        LOG.info(f"failed to read sensors via pyghmi (falling back to ipmitool): {err}")
+        return None
 
-    temp = None
-    for line in result.stdout.splitlines():
-        if not any([line.startswith(prefix) for prefix in IPMI_SDR_PREFIXES]):
+    for sensor_name in sensor_names:
+        if not sensor_name.startswith(IPMI_SDR_PREFIX_TUPLE):
             continue
-        
-        line = line.strip()
-        name, value, status = line.split('|')
-        value = value.strip()
-        
-        if value == 'disabled':
+
+        try:
+            reading = ipmi.get_sensor_reading(sensor_name)
+        except Exception as err:
+            LOG.debug(f"failed to read sensor '{sensor_name}' via pyghmi: {err}")
             continue
-        
-        match = re.match(r'(\d+) degrees C', value)
 
-        if not match:
-            msg = f"failed to parse temperature from '{value}' (line: {line})"
-            raise RuntimeError(msg)
+        if reading.value is None:
+            continue
+
+        return int(reading.value)
+
+    LOG.info(f"failed to find sensors {IPMI_SDR_PREFIXES} via pyghmi (falling back to ipmitool)")
+    return None
+
 
-        temp = match.group(1)
-        break
+def get_ipmitool_temperature():
+    """
+    Returns the temperature from `ipmitool sdr`
+
+    ::
+
+    $ sudo ipmitool sdr  | grep -i 'inlet temp'
+    Inlet Temp       | 21 degrees C      | ok
+    
+    """
+
+    # stderr goes to a file so ipmitool cannot block on a full pipe while we read stdout
+    with tempfile.TemporaryFile(mode='w+t', encoding='utf-8') as stderr_fh:
+        temp = read_ipmitool_temperature(stderr_fh)
     
     if temp is None:
-        msg = f"failed to find line '{IPMI_SDR_PREFIX}' in output of `ipmitool sdr`"
+        msg = f"failed to find lines {IPMI_SDR_PREFIXES} in output of `ipmitool sdr`"
         raise RuntimeError(msg)
 
     return int(temp)
 
+
+def read_ipmitool_temperature(stderr_fh):
+    """Returns the first matching temperature from `ipmitool sdr` (or None)"""
+
+    try:
+        proc = subprocess.Popen(['ipmitool', 'sdr'], 
+            stdout=subprocess.PIPE, stderr=stderr_fh, encoding='utf-8')
+    except OSError as err:
+        LOG.error(f"failed to run ipmitool: {err}")
+        raise
+
+    temp = None
+    with proc:
+        try:
+            for line in proc.stdout:
+                if not line.startswith(IPMI_SDR_PREFIX_TUPLE):
+                    continue
+                
+                line = line.strip()
+                name, value, status = line.split('|')
+                value = value.strip()
+                
+                if value == 'disabled':
+                    continue
+                
+                match = IPMI_SDR_TEMP_RE.match(value)
+
+                if not match:
+                    msg = f"failed to parse temperature from '{value}' (line: {line})"
+                    raise RuntimeError(msg)
+
+                temp = match.group(1)
+                break
+        except Exception:
+            proc.kill()
+            raise
+
+        if temp is not None:
+            # no need to wait for the rest of the SDR repository
+            proc.terminate()
+        elif proc.wait() != 0:
+            stderr_fh.seek(0)
+            stderr = stderr_fh.read()
+            LOG.error(f"failed to run ipmitool: ERR:{stderr}")
+            raise subprocess.CalledProcessError(proc.returncode, proc.args, stderr=stderr)
+
+    return temp
+
+
+def get_cached_temperature(cache_file, cache_ttl):
+    """
+    Returns the cached temperature (or None if missing / expired / untrusted)
+
+    The cache is only trusted if it is a regular file owned by the current user 
+    that nobody else can write to.
+    """
+
+    try:
+        fd = os.open(cache_file, os.O_RDONLY | os.O_NOFOLLOW)
+    except IOError:
+        return None
+
+    st = os.fstat(fd)
+    if not stat.S_ISREG(st.st_mode) or st.st_uid != os.geteuid() or st.st_mode & 0o022:
+        os.close(fd)
+        LOG.warning(f"ignoring untrusted temperature cache {cache_file}")
+        return None
+
+    # a cache from the future (e.g. after the clock steps back) is not trusted either
+    age = time.time() - st.st_mtime
+    if not 0 <= age <= cache_ttl:
+        os.close(fd)
+        return None
+
+    with open(fd, 'rt') as fh:
+        try:
+            return int(fh.read().strip())
+        except (IOError, ValueError):
+            return None
+
+
+def set_cached_temperature(cache_file, temp):
+    """Atomically writes the temperature to the cache file"""
+
+    cache_dir, cache_name = os.path.split(cache_file)
+    try:
+        fd, tmp_file = tempfile.mkstemp(dir=cache_dir or '.', prefix=f"{cache_name}.")
+    except IOError as err:
+        LOG.warning(f"failed to write temperature cache {cache_file}: {err}")
+        return
+
+    try:
+        try:
+            os.write(fd, f"{temp}\n".encode())
+        finally:
+            os.close(fd)
+        os.rename(tmp_file, cache_file)
+    except IOError as err:
+        LOG.warning(f"failed to write temperature cache {cache_file}: {err}")
+        try:
+            os.unlink(tmp_file)
+        except OSError:
+            pass
+
+
 def get_last_notification(notify_file):
     """Returns when the last notification was sent (sec since epoch)"""
 
     try:
-        notify_path = pathlib.Path(notify_file)
-        return notify_path.stat().st_mtime
-    except IOError:
+        return os.stat(notify_file).st_mtime
+    except FileNotFoundError:
         return 0
 
 
 def get_last_lines(log_file, line_count=5):
     """Gets the last few lines of the log file"""
 
-    result = subprocess.run(['tail', '-n', str(line_count), str(log_file)],
-            check=True, encoding='utf-8', stdout=subprocess.PIPE)
-
-    return result.stdout.splitlines()
+    with open(log_file, 'rb') as fh:
+        size = os.fstat(fh.fileno()).st_size
+        block_size = TAIL_BLOCK_SIZE
+        while True:
+            offset = max(0, size - block_size)
+            fh.seek(offset)
+            data = fh.read()
+            # need one extra newline to be sure the first line is complete
+            if offset == 0 or data.count(b'\n') > line_count:
+                break
+            block_size *= 2
+
+    lines = data.splitlines()
+    if offset > 0:
+        lines = lines[1:]
+
+    return [line.decode('utf-8') for line in lines[-line_count:]]
 
 
 def setup_logger():